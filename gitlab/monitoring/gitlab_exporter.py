@@ -1,57 +1,205 @@
 import time
-import requests
-from datetime import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from collections import defaultdict
+import atexit
+import orjson
+import httpx
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+import threading
+from dataclasses import dataclass
 import smtplib
 from email.mime.text import MIMEText
+from prometheus_client import CollectorRegistry, Gauge, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
 import config
 
 
 metrics_cache = {
     "last_update": 0,
-    "data": {}
+    "data": {},
+    "rendered": b""  # /metrics body, rendered once per refresh
 }
 
-def gitlab_api(endpoint):
-    """Call GitLab API"""
-    headers = {"PRIVATE-TOKEN": config.GITLAB_TOKEN}
+# Project list changes rarely, so it is refreshed far less often than MR data
+PROJECTS_CACHE_TTL = 300
+projects_cache = {
+    "last_update": 0,
+    "data": []
+}
+
+# GitLab is polled at most this often; scrapes in between (Prometheus scrapes
+# every 10s) just reuse the pre-rendered body. Conditional GETs keep refreshes cheap.
+METRICS_REFRESH_INTERVAL = 60
+_refresh_guard = threading.Lock()
+_refresh_flight = None  # In-flight refresh: {"done": Event, "error": exception or None}
+
+# Upper bound on concurrent GitLab requests (respects API rate limits)
+MAX_CONCURRENT_REQUESTS = 20
+_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
+
+# Label events per (project_id, mr_iid) -> (updated_at, events), LRU-bounded
+LABEL_EVENTS_CACHE_SIZE = 10000
+_label_events_cache = OrderedDict()
+_label_events_lock = threading.Lock()
+
+# Project/MR list responses per URL -> (etag, body, next_page), LRU-bounded
+# (label events are cached per MR in _label_events_cache instead)
+ETAG_CACHE_SIZE = 1000
+_etag_cache = OrderedDict()
+_etag_lock = threading.Lock()
+
+# Shared SMTP connection, logged in on the first alert and reused afterwards
+_smtp = None
+_smtp_lock = threading.Lock()
+
+# Prometheus registry holding only the exporter's own metrics
+REGISTRY = CollectorRegistry()
+GITLAB_MR_TOTAL = Gauge("gitlab_merge_requests_total", "Total merge requests by project", ["project"], registry=REGISTRY)
+GITLAB_REWORK_MRS = Gauge("gitlab_rework_mrs", "MRs with rework label", ["project"], registry=REGISTRY)
+GITLAB_REWORK_ASSIGNED_TO_ME = Gauge("gitlab_rework_assigned_to_me", "MRs with rework assigned to me", ["project"], registry=REGISTRY)
+GITLAB_IN_REVIEW_MRS = Gauge("gitlab_in_review_mrs", "MRs in review", ["project"], registry=REGISTRY)
+GITLAB_REWORK_DONE_MRS = Gauge("gitlab_rework_done_mrs", "MRs with rework done", ["project"], registry=REGISTRY)
+
+# Project metric key -> gauge it is published on
+PROJECT_GAUGES = {
+    "total_mrs": GITLAB_MR_TOTAL,
+    "rework_mrs": GITLAB_REWORK_MRS,
+    "rework_assigned_to_me": GITLAB_REWORK_ASSIGNED_TO_ME,
+    "in_review_mrs": GITLAB_IN_REVIEW_MRS,
+    "rework_done_mrs": GITLAB_REWORK_DONE_MRS,
+}
+
+# Shared HTTP/2 client: concurrent API calls are multiplexed over pooled connections
+# (the transport retries failed connects, gitlab_api retries throttled/5xx responses)
+_client = httpx.Client(
+    headers={"PRIVATE-TOKEN": config.GITLAB_TOKEN},
+    timeout=10,
+    follow_redirects=True,
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=10, max_keepalive_connections=10)
+    )
+)
+atexit.register(_client.close)
+MAX_RETRIES = 3
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+def _lru_put(cache, key, value, max_size):
+    """Store a value in an OrderedDict LRU, evicting the oldest entries (caller holds the lock)"""
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > max_size:
+        cache.popitem(last=False)
+
+def gitlab_api(endpoint, paginate=False, use_etag=True):
+    """Call GitLab API (returns (body, next_page) when paginate=True)"""
     url = f"{config.GITLAB_URL}/api/v4/{endpoint}"
+    cached = None
+    if use_etag:
+        with _etag_lock:
+            cached = _etag_cache.get(url)
+    headers = {"If-None-Match": cached[0]} if cached else {}
     try:
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        return response.json()
+        for attempt in range(MAX_RETRIES + 1):
+            response = _client.get(url, headers=headers)
+            if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                break
+            time.sleep(0.3 * 2 ** attempt)  # Back off before retrying
+        if response.status_code == 304:
+            # Unchanged on GitLab's side, reuse the body we already have
+            _, body, next_page = cached
+            with _etag_lock:
+                if url in _etag_cache:
+                    _etag_cache.move_to_end(url)
+        else:
+            response.raise_for_status()
+            body = orjson.loads(response.content)
+            next_page = response.headers.get("X-Next-Page")
+            etag = response.headers.get("ETag")
+            if etag and use_etag:
+                with _etag_lock:
+                    _lru_put(_etag_cache, url, (etag, body, next_page), ETAG_CACHE_SIZE)
+        return (body, next_page) if paginate else body
     except Exception as e:
         print(f"[ERROR] GitLab API: {e}")
-        return []
+        return (None, None) if paginate else []
+
+def gitlab_api_all(endpoint, use_etag=True):
+    """Call GitLab API and collect every page of a list endpoint (None if any page fails)"""
+    separator = "&" if "?" in endpoint else "?"
+    results = []
+    page = "1"
+    while page:
+        body, page = gitlab_api(f"{endpoint}{separator}per_page=100&page={page}", paginate=True, use_etag=use_etag)
+        if body is None:
+            return None  # A truncated list must not pass for a complete one
+        results.extend(body)
+    return results
 
 def get_all_projects():
-    """Get all projects to monitor by repository name"""
+    """Get all projects to monitor by repository name (None if GitLab can't be listed)"""
+    now = time.time()
+    if projects_cache["data"] and now - projects_cache["last_update"] < PROJECTS_CACHE_TTL:
+        return projects_cache["data"]
+    
+    # One paginated listing of all accessible projects, then look up by path/name
+    by_path = {}
+    by_name = {}
+    listing = gitlab_api_all("projects?membership=true&simple=true")
+    if listing is None:
+        # Never resolve against an incomplete listing: keep the last complete list (None if there is none)
+        return projects_cache["data"] or None
+    for proj in listing:
+        # First match wins, e.g. over a fork or a same-named repo in another group
+        by_path.setdefault(proj['path'], proj)
+        by_name.setdefault(proj['name'], proj)
+    
     projects = []
     for repo_name in config.REPOSITORIES:
-        # Search for project by name (all accessible projects)
-        result = gitlab_api(f"projects?search={repo_name}&membership=true")
-        if result:
-            for proj in result:
-                if proj['path'] == repo_name or proj['name'] == repo_name:
-                    projects.append(proj)
-                    print(f"[FOUND] {proj.get('path_with_namespace')}")
-                    break
-            else:
-                print(f"[NOT FOUND] Repository '{repo_name}' not accessible")
+        proj = by_path.get(repo_name) or by_name.get(repo_name)
+        if proj:
+            projects.append(proj)
+            print(f"[FOUND] {proj.get('path_with_namespace')}")
+        else:
+            print(f"[NOT FOUND] Repository '{repo_name}' not accessible")
+    
+    if projects:
+        projects_cache["data"] = projects
+        projects_cache["last_update"] = now
     return projects
 
 def get_merge_requests(project_id):
-    """Get all merge requests for a project"""
-    return gitlab_api(f"projects/{project_id}/merge_requests?state=opened&per_page=100")
+    """Get all open merge requests for a project (None if the list is incomplete)"""
+    return gitlab_api_all(f"projects/{project_id}/merge_requests?state=opened")
 
 def get_mr_label_events(project_id, mr_iid):
-    """Get label change events for an MR"""
-    return gitlab_api(f"projects/{project_id}/merge_requests/{mr_iid}/resource_label_events")
+    """Get label change events for an MR (None if the list is incomplete)"""
+    return gitlab_api_all(f"projects/{project_id}/merge_requests/{mr_iid}/resource_label_events", use_etag=False)
 
-def calculate_time_in_state(mr, project_id):
-    """Calculate time spent in each state based on label events"""
+def get_cached_label_events(project_id, mr):
+    """Get label events for an MR, skipping the API call if the MR is unchanged"""
+    key = (project_id, mr.get("iid"))
+    updated_at = mr.get("updated_at")
+    with _label_events_lock:
+        cached = _label_events_cache.get(key)
+        if cached and cached[0] == updated_at:
+            _label_events_cache.move_to_end(key)
+            return cached[1]
+    
     events = get_mr_label_events(project_id, mr.get("iid"))
+    if events is None:
+        # Incomplete fetch: never cache it, fall back to the last complete events if any
+        return cached[1] if cached else None
+    with _label_events_lock:
+        _lru_put(_label_events_cache, key, (updated_at, events), LABEL_EVENTS_CACHE_SIZE)
+    return events
+
+def calculate_time_in_state(mr, events, now_utc):
+    """Calculate time spent in each state based on an MR's label events"""
     if not events:
         return None, None, None
     
@@ -59,23 +207,30 @@ def calculate_time_in_state(mr, project_id):
     rework_added = None
     in_review_added = None
     rework_done_added = None
-    created_at = datetime.fromisoformat(mr.get("created_at").replace("Z", "+00:00"))
+    # fromisoformat parses GitLab's trailing "Z" natively on Python 3.11+
+    created_at = datetime.fromisoformat(mr.get("created_at"))
+    label_rework = config.LABEL_REWORK
+    label_in_review = config.LABEL_IN_REVIEW
+    label_rework_done = config.LABEL_REWORK_DONE
     
     for event in events:
-        event_time = datetime.fromisoformat(event.get("created_at").replace("Z", "+00:00"))
         label = event.get("label")
-        if not label:
+        if not label or event.get("action") != "add":  # action is "add" or "remove"
             continue
         label_name = label.get("name")
-        action = event.get("action")  # "add" or "remove"
         
-        if action == "add":
-            if label_name == config.LABEL_REWORK and not rework_added:
-                rework_added = event_time
-            elif label_name == config.LABEL_IN_REVIEW and not in_review_added:
-                in_review_added = event_time
-            elif label_name == config.LABEL_REWORK_DONE and not rework_done_added:
-                rework_done_added = event_time
+        # Only parse the timestamp for the first add of a tracked label
+        if label_name == label_rework and not rework_added:
+            rework_added = datetime.fromisoformat(event.get("created_at"))
+        elif label_name == label_in_review and not in_review_added:
+            in_review_added = datetime.fromisoformat(event.get("created_at"))
+        elif label_name == label_rework_done and not rework_done_added:
+            rework_done_added = datetime.fromisoformat(event.get("created_at"))
+        else:
+            continue
+        
+        if rework_added and in_review_added and rework_done_added:
+            break  # All three labels found, later events can't change anything
     
     # Calculate durations in hours
     time_in_rework = None
@@ -86,19 +241,51 @@ def calculate_time_in_state(mr, project_id):
         time_in_rework = (rework_done_added - rework_added).total_seconds() / 3600
     
     if in_review_added:
-        now = datetime.now(in_review_added.tzinfo)
         if rework_done_added:
             time_in_review = (rework_done_added - in_review_added).total_seconds() / 3600
         else:
-            time_in_review = (now - in_review_added).total_seconds() / 3600
+            time_in_review = (now_utc - in_review_added).total_seconds() / 3600
     
     if rework_done_added:
         time_to_complete = (rework_done_added - created_at).total_seconds() / 3600
     
     return time_in_rework, time_in_review, time_to_complete
 
+def _get_smtp():
+    """Return a logged-in SMTP connection, reconnecting if it was dropped (caller holds _smtp_lock)"""
+    global _smtp
+    if _smtp is not None:
+        try:
+            if _smtp.noop()[0] == 250:
+                return _smtp
+        except (smtplib.SMTPException, OSError):
+            pass
+        _smtp.close()
+        _smtp = None
+    
+    server = smtplib.SMTP(config.SMTP_HOST, config.SMTP_PORT)
+    try:
+        server.starttls()
+        server.login(config.SMTP_USER, config.SMTP_PASSWORD)
+    except Exception:
+        server.close()  # Not stored in _smtp yet, so nothing else would close it
+        raise
+    _smtp = server
+    return server
+
+def _close_smtp():
+    """Close the shared SMTP connection on exit"""
+    if _smtp is not None:
+        try:
+            _smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+atexit.register(_close_smtp)
+
 def send_email_alert(subject, body):
     """Send email notification"""
+    global _smtp
     if not all([config.SMTP_USER, config.SMTP_PASSWORD, config.YOUR_EMAIL]):
         return  # Email not configured
     
@@ -108,79 +295,129 @@ def send_email_alert(subject, body):
         msg['From'] = config.SMTP_USER
         msg['To'] = config.YOUR_EMAIL
         
-        with smtplib.SMTP(config.SMTP_HOST, config.SMTP_PORT) as server:
-            server.starttls()
-            server.login(config.SMTP_USER, config.SMTP_PASSWORD)
-            server.send_message(msg)
+        with _smtp_lock:
+            try:
+                _get_smtp().send_message(msg)
+            except Exception:
+                # Drop the connection so the next alert reconnects
+                if _smtp is not None:
+                    _smtp.close()
+                    _smtp = None
+                raise
         print(f"[EMAIL] Sent: {subject}")
     except Exception as e:
         pass  # Silently fail if email not configured
 
+@dataclass(slots=True)
+class BranchData:
+    """Branch-level metrics for one open MR"""
+    project: str
+    branch: str
+    target_branch: str
+    mr_title: str  # Limited to 50 chars for the title label
+    time_in_rework: float
+    time_in_review: float
+    time_to_complete: float
+
 def collect_metrics():
-    """Collect GitLab metrics"""
-    now = time.time()
+    """Collect GitLab metrics, running at most one refresh at a time (single-flight)"""
+    global _refresh_flight
+    if time.time() - metrics_cache["last_update"] < METRICS_REFRESH_INTERVAL:
+        return metrics_cache["data"]
+    
+    # Join the in-flight refresh, or start one; decided under the guard so no scrape misses it
+    with _refresh_guard:
+        flight = _refresh_flight
+        leader = flight is None
+        if leader:
+            flight = {"done": threading.Event(), "error": None}
+            _refresh_flight = flight
     
-    # Cache for 10 seconds for real-time updates
-    if now - metrics_cache["last_update"] < 10:
+    if not leader:
+        # Another request is already refreshing: wait for it and share its result
+        flight["done"].wait()
+        if flight["error"] is not None:
+            raise RuntimeError(f"Metrics refresh failed: {flight['error']}")
         return metrics_cache["data"]
     
+    try:
+        # A refresh may have finished between the check above and taking the guard
+        now = time.time()
+        if now - metrics_cache["last_update"] < METRICS_REFRESH_INTERVAL:
+            return metrics_cache["data"]
+        return refresh_metrics(now)
+    except Exception as e:
+        flight["error"] = e
+        raise
+    finally:
+        with _refresh_guard:
+            _refresh_flight = None
+        flight["done"].set()
+
+def refresh_metrics(now):
+    """Fetch fresh metrics from GitLab and store them in the cache"""
     print(f"[{datetime.now().strftime('%H:%M:%S')}] Collecting GitLab metrics...")
     
-    metrics = defaultdict(lambda: defaultdict(int))
-    branch_metrics = []  # List of dicts with branch-level data
+    metrics = {}
+    branch_metrics = []  # List of BranchData rows
     rework_mrs = []
     
     projects = get_all_projects()
+    if projects is None:
+        raise RuntimeError("Project list unavailable")
+    now_utc = datetime.now(timezone.utc)  # GitLab timestamps are UTC
+    my_username = config.YOUR_EMAIL.split("@")[0]
+    
+    # Fetch MR lists for all projects concurrently
+    mrs_per_project = list(_executor.map(get_merge_requests, [p.get("id") for p in projects]))
     
-    for project in projects:
+    for project, mrs in zip(projects, mrs_per_project):
         project_id = project.get("id")
         project_name = project.get("path_with_namespace", "unknown")
         
-        # Initialize all metrics to 0 for this project
-        metrics[project_name]["total_mrs"] = 0
-        metrics[project_name]["rework_mrs"] = 0
-        metrics[project_name]["rework_assigned_to_me"] = 0
-        metrics[project_name]["in_review_mrs"] = 0
-        metrics[project_name]["rework_done_mrs"] = 0
+        if mrs is None:
+            # Fail the refresh so the previous complete snapshot keeps being served
+            raise RuntimeError(f"Incomplete merge request list for {project_name}")
         
-        mrs = get_merge_requests(project_id)
+        # Per-project counters, stored into metrics once the MRs are counted
+        total_mrs = rework_count = rework_assigned_to_me = in_review_count = rework_done_count = 0
         
-        for mr in mrs:
-            labels = mr.get("labels", [])
-            assignees = [a.get("username") for a in mr.get("assignees", [])]
+        # Fetch label events for all MRs of this project concurrently
+        events_per_mr = _executor.map(get_cached_label_events, repeat(project_id), mrs)
+        
+        for mr, events in zip(mrs, events_per_mr):
+            labels = frozenset(mr.get("labels", []))
+            assignees = {a.get("username") for a in mr.get("assignees", [])}
             source_branch = mr.get("source_branch", "unknown")
             target_branch = mr.get("target_branch", "main")
             mr_title = mr.get("title", "")
             mr_id = mr.get("iid")
             
             # Total MRs
-            metrics[project_name]["total_mrs"] += 1
+            total_mrs += 1
             
             # Calculate time metrics for this specific MR
-            time_in_rework, time_in_review, time_to_complete = calculate_time_in_state(mr, project_id)
+            time_in_rework, time_in_review, time_to_complete = calculate_time_in_state(mr, events, now_utc)
             
             # Store branch-level metrics
-            branch_data = {
-                "project": project_name,
-                "branch": source_branch,
-                "target_branch": target_branch,
-                "mr_title": mr_title,
-                "time_in_rework": time_in_rework or 0,
-                "time_in_review": time_in_review or 0,
-                "time_to_complete": time_to_complete or 0,
-                "has_rework": config.LABEL_REWORK in labels,
-                "has_in_review": config.LABEL_IN_REVIEW in labels,
-                "has_rework_done": config.LABEL_REWORK_DONE in labels
-            }
+            branch_data = BranchData(
+                project=project_name,
+                branch=source_branch,
+                target_branch=target_branch,
+                mr_title=mr_title[:50],
+                time_in_rework=time_in_rework or 0,
+                time_in_review=time_in_review or 0,
+                time_to_complete=time_to_complete or 0
+            )
             branch_metrics.append(branch_data)
             
             # Track by label
             if config.LABEL_REWORK in labels:
-                metrics[project_name]["rework_mrs"] += 1
+                rework_count += 1
                 
                 # Check if assigned to YOU (check assignee username)
-                if config.YOUR_EMAIL.split("@")[0] in assignees:
-                    metrics[project_name]["rework_assigned_to_me"] += 1
+                if my_username in assignees:
+                    rework_assigned_to_me += 1
                     rework_mrs.append({
                         "title": mr.get("title"),
                         "url": mr.get("web_url"),
@@ -189,10 +426,18 @@ def collect_metrics():
                     })
             
             if config.LABEL_IN_REVIEW in labels:
-                metrics[project_name]["in_review_mrs"] += 1
+                in_review_count += 1
             
             if config.LABEL_REWORK_DONE in labels:
-                metrics[project_name]["rework_done_mrs"] += 1
+                rework_done_count += 1
+        
+        metrics[project_name] = {
+            "total_mrs": total_mrs,
+            "rework_mrs": rework_count,
+            "rework_assigned_to_me": rework_assigned_to_me,
+            "in_review_mrs": in_review_count,
+            "rework_done_mrs": rework_done_count
+        }
     
     # Send email if new rework MRs assigned to you
     if rework_mrs and metrics_cache.get("last_rework_count", 0) < len(rework_mrs):
@@ -201,84 +446,87 @@ def collect_metrics():
             body += f"• {mr['title']}\n  {mr['url']}\n  Project: {mr['project']}\n\n"
         send_email_alert("⚠️ GitLab: Rework Assigned to You", body)
     
+    # Publish project-level gauges (cleared first so removed projects disappear)
+    for key, gauge in PROJECT_GAUGES.items():
+        gauge.clear()
+        for project_name, stats in metrics.items():
+            gauge.labels(project=project_name).set(stats[key])
+    
     result = {
-        "project_metrics": dict(metrics),
+        "project_metrics": metrics,
         "branch_metrics": branch_metrics
     }
     
     metrics_cache["data"] = result
+    # Render the exposition once here so scrapes only copy pre-encoded bytes
+    metrics_cache["rendered"] = generate_latest(REGISTRY)
     metrics_cache["last_update"] = now
     metrics_cache["last_rework_count"] = len(rework_mrs)
     
     return result
 
+class BranchMetricsCollector(Collector):
+    """Expose per-MR metrics from the latest collected data (rendered once per refresh)"""
+    
+    def collect(self):
+        branch_metrics = metrics_cache["data"].get("branch_metrics", [])
+        label_names = ["project", "branch", "target", "title"]
+        
+        mr_info = GaugeMetricFamily("gitlab_mr_info", "MR information with branch labels", labels=label_names)
+        time_in_rework = GaugeMetricFamily("gitlab_mr_time_in_rework_hours", "Time spent in rework per MR (hours)", labels=label_names)
+        time_in_review = GaugeMetricFamily("gitlab_mr_time_in_review_hours", "Time spent in review per MR (hours)", labels=label_names)
+        time_to_complete = GaugeMetricFamily("gitlab_mr_time_to_complete_hours", "Time to complete MR (hours)", labels=label_names)
+        
+        # Branch-level metrics - ALWAYS expose for ALL MRs
+        for branch_data in branch_metrics:
+            labels = [branch_data.project, branch_data.branch, branch_data.target_branch, branch_data.mr_title]
+            
+            # Always expose MR info (value=1) so branches are always available in dropdown
+            mr_info.add_metric(labels, 1)
+            
+            # Time metrics (only if > 0)
+            if branch_data.time_in_rework > 0:
+                time_in_rework.add_metric(labels, round(branch_data.time_in_rework, 2))
+            
+            if branch_data.time_in_review > 0:
+                time_in_review.add_metric(labels, round(branch_data.time_in_review, 2))
+            
+            if branch_data.time_to_complete > 0:
+                time_to_complete.add_metric(labels, round(branch_data.time_to_complete, 2))
+        
+        yield mr_info
+        yield time_in_rework
+        yield time_in_review
+        yield time_to_complete
+
+REGISTRY.register(BranchMetricsCollector())
+
+# generate_latest() with default settings emits the 0.0.4 text format
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
 class MetricsHandler(BaseHTTPRequestHandler):
     """HTTP handler for Prometheus /metrics endpoint"""
     
     def do_GET(self):
         if self.path == "/metrics":
             try:
-                data = collect_metrics()
-                project_metrics = data.get("project_metrics", {})
-                branch_metrics = data.get("branch_metrics", [])
-                
-                lines = [
-                    "# HELP gitlab_merge_requests_total Total merge requests by project",
-                    "# TYPE gitlab_merge_requests_total gauge",
-                    "# HELP gitlab_rework_mrs MRs with rework label",
-                    "# TYPE gitlab_rework_mrs gauge",
-                    "# HELP gitlab_rework_assigned_to_me MRs with rework assigned to me",
-                    "# TYPE gitlab_rework_assigned_to_me gauge",
-                    "# HELP gitlab_in_review_mrs MRs in review",
-                    "# TYPE gitlab_in_review_mrs gauge",
-                    "# HELP gitlab_rework_done_mrs MRs with rework done",
-                    "# TYPE gitlab_rework_done_mrs gauge",
-                    "# HELP gitlab_mr_info MR information with branch labels",
-                    "# TYPE gitlab_mr_info gauge",
-                    "# HELP gitlab_mr_time_in_rework_hours Time spent in rework per MR (hours)",
-                    "# TYPE gitlab_mr_time_in_rework_hours gauge",
-                    "# HELP gitlab_mr_time_in_review_hours Time spent in review per MR (hours)",
-                    "# TYPE gitlab_mr_time_in_review_hours gauge",
-                    "# HELP gitlab_mr_time_to_complete_hours Time to complete MR (hours)",
-                    "# TYPE gitlab_mr_time_to_complete_hours gauge",
-                ]
-                
-                # Project-level metrics
-                for project, stats in project_metrics.items():
-                    lines.append(f'gitlab_merge_requests_total{{project="{project}"}} {stats["total_mrs"]}')
-                    lines.append(f'gitlab_rework_mrs{{project="{project}"}} {stats["rework_mrs"]}')
-                    lines.append(f'gitlab_rework_assigned_to_me{{project="{project}"}} {stats["rework_assigned_to_me"]}')
-                    lines.append(f'gitlab_in_review_mrs{{project="{project}"}} {stats["in_review_mrs"]}')
-                    lines.append(f'gitlab_rework_done_mrs{{project="{project}"}} {stats["rework_done_mrs"]}')
-                
-                # Branch-level metrics - ALWAYS expose for ALL MRs
-                for branch_data in branch_metrics:
-                    project = branch_data["project"]
-                    branch = branch_data["branch"].replace('"', '\\"')
-                    target = branch_data["target_branch"].replace('"', '\\"')
-                    title = branch_data["mr_title"].replace('"', '\\"')[:50]  # Limit length
-                    
-                    # Always expose MR info (value=1) so branches are always available in dropdown
-                    lines.append(f'gitlab_mr_info{{project="{project}",branch="{branch}",target="{target}",title="{title}"}} 1')
-                    
-                    # Time metrics (only if > 0)
-                    if branch_data["time_in_rework"] > 0:
-                        lines.append(f'gitlab_mr_time_in_rework_hours{{project="{project}",branch="{branch}",target="{target}",title="{title}"}} {branch_data["time_in_rework"]:.2f}')
-                    
-                    if branch_data["time_in_review"] > 0:
-                        lines.append(f'gitlab_mr_time_in_review_hours{{project="{project}",branch="{branch}",target="{target}",title="{title}"}} {branch_data["time_in_review"]:.2f}')
-                    
-                    if branch_data["time_to_complete"] > 0:
-                        lines.append(f'gitlab_mr_time_to_complete_hours{{project="{project}",branch="{branch}",target="{target}",title="{title}"}} {branch_data["time_to_complete"]:.2f}')
-                
-                self.send_response(200)
-                self.send_header('Content-type', 'text/plain; charset=utf-8')
-                self.end_headers()
-                self.wfile.write('\n'.join(lines).encode())
+                collect_metrics()
             except Exception as e:
+                # A failed refresh publishes nothing; keep serving the last complete snapshot
                 print(f"[ERROR] /metrics: {e}")
+            
+            output = metrics_cache["rendered"]
+            if not output:
+                # No snapshot collected yet, so there is nothing valid to serve
                 self.send_response(500)
                 self.end_headers()
+                return
+            
+            self.send_response(200)
+            self.send_header('Content-type', METRICS_CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(output)))
+            self.end_headers()
+            self.wfile.write(output)
         else:
             self.send_response(404)
             self.end_headers()
@@ -296,6 +544,7 @@ if __name__ == "__main__":
     print(f"Monitoring: {', '.join(config.REPOSITORIES)}")
     print(f"Listening on http://0.0.0.0:9200/metrics\n")
     
-    server = HTTPServer(('0.0.0.0', 9200), MetricsHandler)
+    # Each scrape gets its own thread so a slow refresh doesn't block other clients
+    server = ThreadingHTTPServer(('0.0.0.0', 9200), MetricsHandler)
     server.serve_forever()
 